@@ -1,21 +1,106 @@
+import asyncio
+import random
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.redis import RedisBackend
+from fastapi_cache.decorator import cache
 import httpx
+import orjson
 import hashlib
 import os
 import time
 import re
-from typing import List, Dict
+import sys
+import weakref
+from functools import lru_cache, partial
+from typing import AsyncIterator, Awaitable, List, Dict, Set, Tuple
 
+from aiolimiter import AsyncLimiter
 from loguru import logger
+from redis import asyncio as aioredis
 
 
-app = FastAPI(title="Marvel API With FastAPI", version="1.0.0")
-
 # Please replace these with your Marvel API keys obtained from developer.marvel.com
 PUBLIC_KEY = os.environ.get("marvel_pubkey", None)
 PRIVATE_KEY = os.environ.get("marvel_privkey", None)
+# The keys never change at runtime, so encode the hashed suffix once
+_KEY_SUFFIX_BYTES = f"{PRIVATE_KEY}{PUBLIC_KEY}".encode()
 BASE_URL = "https://gateway.marvel.com:443/v1/public"
 BATCH_SIZE = 50  # Number of characters to retrieve per request
+MAX_CHARACTERS_LIMIT = 2000  # Caps /characters_all at 40 batches per request
+MAX_CONCURRENT_BATCHES = 8  # Upper bound on in-flight requests to Marvel
+MARVEL_RATE_LIMIT = 50  # Requests per second allowed towards Marvel; tune to plan
+MAX_RETRIES = 5  # Attempts per request when Marvel answers 429 or 5xx
+REDIS_URL = os.environ.get("redis_url", "redis://localhost")
+CACHE_PREFIX = "marvel-cache"
+LIST_CACHE_EXPIRE = 60 * 60  # Lists change at most daily; refresh hourly
+CHARACTER_CACHE_EXPIRE = 24 * 60 * 60
+STALE_CACHE_EXPIRE = 24 * 60 * 60  # Last good /characters payload, served on failure
+
+# Hand log records to a background thread so writes never block the event loop
+logger.remove()
+logger.add(sys.stderr, enqueue=True, level="INFO", backtrace=False, diagnose=False)
+
+# One semaphore per event loop; a semaphore binds to the first loop it waits on
+_batch_semaphores: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_limiter = AsyncLimiter(MARVEL_RATE_LIMIT, 1)
+# Upstream requests currently in flight, keyed by stale cache key and fallback
+_inflight: Dict[Tuple[str, bool], asyncio.Task] = {}
+# Number of callers currently awaiting each in-flight request
+_inflight_waiters: Dict[asyncio.Task, int] = {}
+# Fire-and-forget cache writes, referenced until they finish
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def get_batch_semaphore() -> asyncio.Semaphore:
+    """Returns the semaphore bounding upstream requests on the running event loop.
+
+    Returns:
+        asyncio.Semaphore: A semaphore allowing MAX_CONCURRENT_BATCHES requests.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _batch_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+        _batch_semaphores[loop] = semaphore
+    return semaphore
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Manages the shared HTTP client used to talk to the Marvel API.
+
+    A single client is created at startup and closed at shutdown so that
+    connections (and their TLS sessions) are reused across requests; HTTP/2 is
+    negotiated where Marvel offers it. The Redis-backed response cache is
+    initialised here as well.
+    """
+    redis = aioredis.from_url(REDIS_URL)
+    FastAPICache.init(RedisBackend(redis), prefix=CACHE_PREFIX)
+    app.state.client = httpx.AsyncClient(
+        base_url=BASE_URL,
+        http2=True,  # Concurrent batch requests multiplex over one connection
+        limits=httpx.Limits(
+            max_keepalive_connections=50, max_connections=100, keepalive_expiry=30
+        ),
+        timeout=10.0,
+    )
+    yield
+    await app.state.client.aclose()
+    await redis.close()
+    await logger.complete()
+
+
+app = FastAPI(
+    title="Marvel API With FastAPI",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 
 def generate_marvel_hash(ts: str) -> str:
@@ -27,15 +112,46 @@ def generate_marvel_hash(ts: str) -> str:
     Returns:
         str: The generated MD5 hash based on the timestamp, private key, and public key.
     """
-    to_hash = f"{ts}{PRIVATE_KEY}{PUBLIC_KEY}"
-    return hashlib.md5(to_hash.encode()).hexdigest()
+    md5 = hashlib.md5(usedforsecurity=False)
+    md5.update(ts.encode())
+    md5.update(_KEY_SUFFIX_BYTES)
+    return md5.hexdigest()
+
+
+@lru_cache(maxsize=4)
+def _auth_for_bucket(bucket: int) -> httpx.QueryParams:
+    """Builds the authentication query parameters for a one-second time bucket.
+
+    Requests arriving within the same second share a single MD5 computation
+    and a single immutable set of query parameters.
+    """
+    ts = str(bucket)
+    return httpx.QueryParams(
+        {
+            "ts": ts,
+            "apikey": PUBLIC_KEY,
+            "hash": generate_marvel_hash(ts),
+            "orderBy": "name",
+        }
+    )
+
+
+def get_auth_query_params() -> httpx.QueryParams:
+    """Returns the shared authentication query parameters for the current second.
+
+    Returns:
+        httpx.QueryParams: Immutable parameters; use ``merge`` to add per-request
+        values such as ``limit`` and ``offset``.
+    """
+    return _auth_for_bucket(int(time.time()))
 
 
 def get_auth_params() -> dict:
     """Generates authentication parameters for the Marvel API.
 
     Returns:
-        dict: A dictionary containing the timestamp, API key, and hash required for authentication.
+        dict: A fresh dictionary containing the timestamp, API key, and hash required
+        for authentication. The timestamp has one-second resolution.
 
     This dictionary includes:
         - ts: The timestamp for the request.
@@ -43,13 +159,154 @@ def get_auth_params() -> dict:
         - hash: The MD5 hash generated using the timestamp, private key, and public key.
         - orderBy: Sorts characters by name (optional).
     """
-    ts = str(time.time())
-    return {
-        "ts": ts,
-        "apikey": PUBLIC_KEY,
-        "hash": generate_marvel_hash(ts),
-        "orderBy": "name",
-    }
+    return dict(get_auth_query_params().items())
+
+
+async def marvel_get(path: str, params: httpx.QueryParams) -> httpx.Response:
+    """
+    Sends a rate-limited GET to the Marvel API, retrying throttled requests.
+
+    Args:
+        path (str): The Marvel API path, relative to BASE_URL.
+        params (httpx.QueryParams): The query parameters, including authentication.
+
+    Returns:
+        httpx.Response: The last response received from Marvel.
+
+    Requests answered with 429 or a 5xx status are retried with exponential
+    backoff and jitter, up to MAX_RETRIES attempts in total.
+    """
+    for attempt in range(MAX_RETRIES):
+        async with _limiter:
+            response = await app.state.client.get(path, params=params)
+        if response.status_code != 429 and response.status_code < 500:
+            break
+        if attempt < MAX_RETRIES - 1:
+            await asyncio.sleep(2**attempt + random.random())
+    return response
+
+
+def stale_cache_key(path: str, params: httpx.QueryParams) -> str:
+    """Builds the cache key under which the last good upstream payload is kept.
+
+    Args:
+        path (str): The Marvel API path that was requested.
+        params (httpx.QueryParams): The query parameters sent with the request.
+
+    Returns:
+        str: A key that ignores the per-request authentication parameters.
+    """
+    stable = sorted(
+        (key, value)
+        for key, value in params.items()
+        if key not in ("ts", "hash", "apikey")
+    )
+    return f"{CACHE_PREFIX}:stale:{path}?{httpx.QueryParams(stable)}"
+
+
+async def get_marvel_data(
+    path: str, params: httpx.QueryParams, detail: str, fallback: bool = False
+) -> dict:
+    """
+    Requests a Marvel API path, optionally falling back to the last good payload.
+
+    Concurrent calls for the same path, non-auth parameters and fallback setting
+    share a single upstream request, run as its own task; every caller receives
+    its result or its exception, and a cancelled caller leaves the request
+    running for others. The request is only cancelled once no caller is waiting
+    for it.
+
+    Args:
+        path (str): The Marvel API path, relative to BASE_URL.
+        params (httpx.QueryParams): The query parameters, including authentication.
+        detail (str): The error detail to report if no fallback is available.
+        fallback (bool, optional): Keep the last good payload and serve it when
+            Marvel fails. Defaults to False.
+
+    Returns:
+        dict: The decoded JSON payload.
+
+    Raises:
+        HTTPException: If the request fails and no previous payload is cached.
+    """
+    key = stale_cache_key(path, params)
+    # The fallback choice is baked into the shared request, so it is part of
+    # what makes two calls identical
+    inflight_key = (key, fallback)
+    task = _inflight.get(inflight_key)
+    if task is None:
+        task = asyncio.ensure_future(
+            _request_marvel_data(path, params, key, detail, fallback)
+        )
+        _inflight[inflight_key] = task
+        _inflight_waiters[task] = 0
+        task.add_done_callback(partial(_forget_inflight, inflight_key))
+
+    _inflight_waiters[task] += 1
+    try:
+        # Cancelling one caller must not cancel the request the others wait on
+        return await asyncio.shield(task)
+    finally:
+        remaining = _inflight_waiters.get(task)
+        if remaining is not None:
+            _inflight_waiters[task] = remaining - 1
+            if remaining == 1 and not task.done():
+                # Every caller has gone away, so stop the request as well
+                task.cancel()
+
+
+def _forget_inflight(key: Tuple[str, bool], task: asyncio.Task) -> None:
+    """Drops a finished upstream request from the in-flight map."""
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    _inflight_waiters.pop(task, None)
+    if not task.cancelled():
+        task.exception()  # Mark as retrieved when every caller has gone away
+
+
+async def _store_stale_payload(key: str, content: bytes) -> None:
+    """Writes the last good upstream payload to the cache backend."""
+    try:
+        await FastAPICache.get_backend().set(key, content, STALE_CACHE_EXPIRE)
+    except Exception:
+        logger.warning(f"Could not store fallback payload for {key}")
+
+
+async def _request_marvel_data(
+    path: str, params: httpx.QueryParams, key: str, detail: str, fallback: bool
+) -> dict:
+    """Performs the upstream request behind get_marvel_data."""
+    try:
+        # Held by the shared task, so cancelled callers don't free the slot
+        # while their request is still running
+        async with get_batch_semaphore():
+            response = await marvel_get(path, params)
+    except httpx.HTTPError as exc:
+        logger.info(f"Marvel request failed: {exc!r}")
+        status_code = 502
+    else:
+        if response.status_code == 200:
+            if fallback:
+                # Don't hold the response back on the cache write
+                task = asyncio.create_task(_store_stale_payload(key, response.content))
+                _background_tasks.add(task)
+                task.add_done_callback(_background_tasks.discard)
+            return orjson.loads(response.content)
+        status_code = response.status_code
+
+    stale = None
+    if fallback:
+        try:
+            stale = await FastAPICache.get_backend().get(key)
+        except Exception:
+            stale = None
+
+    if stale is None:
+        logger.info("looks like we did not get the right result.")
+        raise HTTPException(status_code=status_code, detail=detail)
+
+    logger.info(f"Marvel request failed with {status_code}, serving stale {key}")
+    return orjson.loads(stale)
 
 
 @app.get("/")
@@ -68,6 +325,7 @@ def base():
 
 
 @app.get("/characters")
+@cache(expire=LIST_CACHE_EXPIRE)
 async def get_characters_with_info(limit: int = 10, offset: int = 0):
     """
     Fetches a list of Marvel characters asynchronously.
@@ -82,20 +340,73 @@ async def get_characters_with_info(limit: int = 10, offset: int = 0):
     Raises:
         HTTPException: If the request to the Marvel API fails.
     """
-    url = f"{BASE_URL}/characters"
-    params = get_auth_params()
-    params.update({"limit": limit, "offset": offset})
+    params = get_auth_query_params().merge({"limit": limit, "offset": offset})
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, params=params)
+    return await get_marvel_data(
+        "/characters", params, detail="Failed to fetch characters", fallback=True
+    )
 
-    if response.status_code != 200:
-        logger.info("looks like we did not get the right result.")
-        raise HTTPException(
-            status_code=response.status_code, detail="Failed to fetch characters"
-        )
 
-    return response.json()
+@lru_cache(maxsize=256)
+def _name_regex(name: str) -> re.Pattern:
+    """Compiles the anchored, case-insensitive pattern used to filter names.
+
+    Compiled patterns are cached so repeated searches skip recompilation.
+    """
+    # Create regex pattern:
+    # 1. Escape special regex characters
+    # 2. Replace spaces with flexible whitespace/separator pattern
+    # 3. Make the pattern case insensitive
+    pattern = re.escape(name).replace(r"\ ", r"[\s-]*")
+    return re.compile(f"^{pattern}", re.IGNORECASE)
+
+
+async def _fetch_character_results(
+    limit: int, offset: int, name: str = None
+) -> Tuple[List[Tuple[str, int]], int, int]:
+    """
+    Fetches the name and comic count of each character in a batch, filtered by name.
+
+    Args:
+        limit (int): The number of characters to fetch in this batch.
+        offset (int): The starting index for the batch.
+        name (str, optional): The name pattern to search for. Defaults to None.
+
+    Returns:
+        tuple: (name, comic count) pairs for the characters that match the name
+        pattern, the number of records Marvel returned before filtering, and the
+        total number of records Marvel has for the query.
+
+    Raises:
+        HTTPException: If the request to the Marvel API fails.
+    """
+    query = {"limit": limit, "offset": offset}
+
+    if name:
+        # Clean and prepare the search pattern
+        search_term = name.split()[0]  # Take first word for API search
+
+        regex = _name_regex(name)
+
+        # Use nameStartsWith for broader initial search
+        query["nameStartsWith"] = search_term
+
+    params = get_auth_query_params().merge(query)
+
+    data = await get_marvel_data(
+        "/characters", params, detail="Failed to fetch characters"
+    )
+    results = data["data"]["results"]
+    total = data["data"]["total"]
+    # Filter by the name pattern (if any) and keep only each match's name and
+    # comic count in one pass, so the rest of the payload (thumbnails, URLs,
+    # stories, ...) is released with this batch
+    pairs = [
+        (char["name"], char["comics"]["available"])
+        for char in results
+        if not name or regex.match(char["name"])
+    ]
+    return pairs, len(results), total
 
 
 async def fetch_character_batch(
@@ -121,51 +432,63 @@ async def fetch_character_batch(
         - "spider man" would match "Spider-Man", "Spider-Man (Ultimate)", etc.
         - "peter parker" would match "Peter Parker", "Peter Parker (Ultimate)", etc.
     """
-    url = f"{BASE_URL}/characters"
-    params = get_auth_params()
-    params.update({"limit": limit, "offset": offset})
+    results, _, _ = await _fetch_character_results(limit, offset, name)
+    return [
+        {"name": char_name, "comics_count": comics_count}
+        for char_name, comics_count in results
+    ]
 
-    if name:
-        # Clean and prepare the search pattern
-        search_term = name.split()[0]  # Take first word for API search
 
-        # Create regex pattern:
-        # 1. Escape special regex characters
-        # 2. Replace spaces with flexible whitespace/separator pattern
-        # 3. Make the pattern case insensitive
-        pattern = re.escape(name)
-        pattern = pattern.replace(r"\ ", r"[\s-]*")
-        pattern = f"^{pattern}"
-        regex = re.compile(pattern, re.IGNORECASE)
+async def fetch_character_batch_as_dict(
+    limit: int, offset: int, name: str = None
+) -> Dict[str, int]:
+    """
+    Fetches a batch of characters as a mapping of name to comic count.
 
-        # Use nameStartsWith for broader initial search
-        params["nameStartsWith"] = search_term
+    Same matching rules as fetch_character_batch, but skips building an
+    intermediate dictionary per character.
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, params=params)
+    Args:
+        limit (int): The number of characters to fetch in this batch.
+        offset (int): The starting index for the batch.
+        name (str, optional): The name pattern to search for. Defaults to None.
 
-    if response.status_code != 200:
-        raise HTTPException(
-            status_code=response.status_code,
-            detail="Failed to fetch characters",
-        )
+    Returns:
+        dict: Character names mapped to the number of comics they appear in.
 
-    data = response.json()
-    results = data["data"]["results"]
+    Raises:
+        HTTPException: If the request to the Marvel API fails.
+    """
+    results, _, _ = await _fetch_character_results(limit, offset, name)
+    return dict(results)
 
-    # Filter results using regex if name pattern was provided
-    if name and results:
-        filtered_chars = [
-            {"name": char["name"], "comics_count": char["comics"]["available"]}
-            for char in results
-            if regex.search(char["name"])
-        ]
-        return filtered_chars
-    else:
-        return [
-            {"name": char["name"], "comics_count": char["comics"]["available"]}
-            for char in results
-        ]
+
+async def fetch_character_page(
+    limit: int, offset: int
+) -> Tuple[Dict[str, int], int, int]:
+    """
+    Fetches one page of characters along with Marvel's record counts.
+
+    Args:
+        limit (int): The number of characters to fetch in this batch.
+        offset (int): The starting index for the batch.
+
+    Returns:
+        tuple: Character names mapped to their comic counts, the raw number of
+        records in the page, and the total number of characters Marvel has.
+        Names are de-duplicated in the mapping, so only the raw count tells
+        whether Marvel ran out of characters.
+
+    Raises:
+        HTTPException: If the request to the Marvel API fails.
+    """
+    results, returned, total = await _fetch_character_results(limit, offset)
+    return dict(results), returned, total
+
+
+_RE_PAREN = re.compile(r"\s*\([^)]*\)")
+_RE_SPECIAL = re.compile(r"[^\w\s-]")
+_RE_SEP = re.compile(r"[\s-]+")
 
 
 def standardize_name(name: str) -> str:
@@ -182,13 +505,13 @@ def standardize_name(name: str) -> str:
     and extra whitespace, making the name suitable for comparison and search.
     """
     # Remove parenthetical information
-    name = re.sub(r"\s*\([^)]*\)", "", name)
+    name = _RE_PAREN.sub("", name)
 
     # Remove special characters except hyphen
-    name = re.sub(r"[^\w\s-]", "", name)
+    name = _RE_SPECIAL.sub("", name)
 
     # Replace multiple spaces/separators with single space
-    name = re.sub(r"[\s-]+", " ", name)
+    name = _RE_SEP.sub(" ", name)
 
     return name.strip()
 
@@ -217,7 +540,62 @@ async def search_characters(search_name: str, limit: int = 20) -> List[Dict]:
         )
 
 
+def batch_slices(limit: int, offset: int) -> List[Tuple[int, int]]:
+    """
+    Splits a paginated range of characters into Marvel-sized batches.
+
+    Args:
+        limit (int): The total number of characters to retrieve.
+        offset (int): The starting index of the range.
+
+    Returns:
+        List[Tuple[int, int]]: The (limit, offset) pair for each batch request.
+    """
+    return [
+        (min(BATCH_SIZE, offset + limit - batch_offset), batch_offset)
+        for batch_offset in range(offset, offset + limit, BATCH_SIZE)
+    ]
+
+
+def remaining_batch_slices(
+    limit: int, offset: int, total: int
+) -> List[Tuple[int, int]]:
+    """
+    Lists the batches after the first one, stopping at Marvel's last character.
+
+    Args:
+        limit (int): The total number of characters requested.
+        offset (int): The starting index of the range.
+        total (int): The number of characters Marvel reported in the first batch.
+
+    Returns:
+        List[Tuple[int, int]]: The (limit, offset) pair for each remaining batch.
+    """
+    next_offset = offset + BATCH_SIZE
+    return batch_slices(min(offset + limit, total) - next_offset, next_offset)
+
+
+async def gather_batches(aws: List[Awaitable]) -> list:
+    """
+    Runs batch requests concurrently, cancelling the rest as soon as one fails.
+
+    Args:
+        aws (List[Awaitable]): The batch requests to run.
+
+    Returns:
+        list: The batch results, in the order they were given.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
 @app.get("/characters_all")
+@cache(expire=LIST_CACHE_EXPIRE)
 async def get_all_characters_names(
     limit: int = Query(20, ge=1), offset: int = Query(0, ge=0)
 ):
@@ -225,38 +603,48 @@ async def get_all_characters_names(
     Fetches characters and the quantity of comics in which they appear with pagination.
 
     Args:
-        limit (int, optional): The maximum number of characters to retrieve. Defaults to 100.
+        limit (int, optional): The maximum number of characters to retrieve; values
+            above MAX_CHARACTERS_LIMIT are clamped to it. Defaults to 20.
         offset (int, optional): The starting index for retrieving characters. Defaults to 0.
 
     Returns:
         dict: A dictionary where each key is a character name, and the value is the number of comics they appear in.
     """
-    characters_comics = {}
-    total_retrieved = 0
+    limit = min(limit, MAX_CHARACTERS_LIMIT)
 
-    while total_retrieved < limit:
-        batch_size = min(BATCH_SIZE, limit - total_retrieved)
-        batch = await fetch_character_batch(batch_size, offset + total_retrieved)
-        total_retrieved += len(batch)
+    # The first batch tells us how many characters Marvel has, so only the
+    # batches that can hold results are then requested concurrently
+    characters_comics, returned, total = await fetch_character_page(
+        min(BATCH_SIZE, limit), offset
+    )
+    if returned < BATCH_SIZE:  # Later batches start past the last character
+        return characters_comics
 
+    batches = await gather_batches(
+        [
+            fetch_character_page(batch_size, batch_offset)
+            for batch_size, batch_offset in remaining_batch_slices(limit, offset, total)
+        ]
+    )
+
+    for batch, returned, _ in batches:
         # Update the results dictionary with character comic count
-        for character in batch:
-            characters_comics[character["name"]] = character["comics_count"]
+        characters_comics.update(batch)
 
-        if (
-            len(batch) < BATCH_SIZE
-        ):  # End loop if fewer items than requested are returned
+        if returned < BATCH_SIZE:  # Later batches start past the last character
             break
 
     return characters_comics
 
 
 @app.get("/characters/search/{name}")
+@cache(expire=LIST_CACHE_EXPIRE)
 async def search_characters_endpoint(name: str, limit: int = 20):
     return await search_characters(name, limit)
 
 
 @app.get("/characters/{character_name}")
+@cache(expire=CHARACTER_CACHE_EXPIRE)
 async def get_character_by_name(
     character_name: str, limit: int = Query(10, ge=1), offset: int = Query(0, ge=0)
 ):
@@ -274,7 +662,7 @@ async def get_character_by_name(
     Raises:
         HTTPException: If no character is found with the given name.
     """
-    characters = await fetch_character_batch(
+    characters = await fetch_character_batch_as_dict(
         limit=limit, offset=offset, name=character_name
     )
     if not characters:
@@ -282,4 +670,72 @@ async def get_character_by_name(
             status_code=404, detail=f"No character found with name {character_name}"
         )
 
-    return {character["name"]: character["comics_count"] for character in characters}
+    return characters
+
+
+async def stream_character_rows(
+    first_batch: Dict[str, int], slices: List[Tuple[int, int]]
+) -> AsyncIterator[bytes]:
+    """
+    Yields one NDJSON row per character as each batch arrives from Marvel.
+
+    Args:
+        first_batch (Dict[str, int]): The already fetched first batch.
+        slices (List[Tuple[int, int]]): The (limit, offset) pairs of the remaining
+            batches, requested concurrently once streaming starts.
+
+    Yields:
+        bytes: A JSON object mapping a character name to its comic count,
+        terminated by a newline.
+    """
+    for name, comics_count in first_batch.items():
+        yield orjson.dumps({name: comics_count}) + b"\n"
+
+    tasks = [
+        asyncio.ensure_future(fetch_character_batch_as_dict(batch_size, batch_offset))
+        for batch_size, batch_offset in slices
+    ]
+    try:
+        for next_batch in asyncio.as_completed(tasks):
+            for name, comics_count in (await next_batch).items():
+                yield orjson.dumps({name: comics_count}) + b"\n"
+    finally:
+        # Stop outstanding batches if the client goes away early or a batch
+        # fails; requests other callers share keep running for them
+        for task in tasks:
+            task.cancel()
+
+
+@app.get("/characters_all/stream")
+async def stream_all_characters_names(
+    limit: int = Query(20, ge=1), offset: int = Query(0, ge=0)
+):
+    """
+    Streams characters and their comic counts as newline-delimited JSON.
+
+    Args:
+        limit (int, optional): The maximum number of characters to retrieve; values
+            above MAX_CHARACTERS_LIMIT are clamped to it. Defaults to 20.
+        offset (int, optional): The starting index for retrieving characters. Defaults to 0.
+
+    Returns:
+        StreamingResponse: One ``{"name": comics_count}`` object per line, in the
+        order batches complete rather than by name.
+
+    Raises:
+        HTTPException: If the first batch cannot be fetched from the Marvel API.
+    """
+    limit = min(limit, MAX_CHARACTERS_LIMIT)
+
+    # Fetch the first batch before streaming starts, so upstream failures are
+    # still reported as HTTP errors and Marvel's total bounds the fan-out
+    first_batch, returned, total = await fetch_character_page(
+        min(BATCH_SIZE, limit), offset
+    )
+    slices = []
+    if returned >= BATCH_SIZE:
+        slices = remaining_batch_slices(limit, offset, total)
+
+    return StreamingResponse(
+        stream_character_rows(first_batch, slices), media_type="application/x-ndjson"
+    )
@@ -1,11 +1,30 @@
+import asyncio
+import json
+
+import httpx
 import pytest
 from unittest.mock import patch, AsyncMock
-from fastapi.testclient import TestClient
-
-from main import app, generate_marvel_hash, get_auth_params
-
-# Create test client
-client = TestClient(app)
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+
+from main import (
+    BASE_URL,
+    BATCH_SIZE,
+    MAX_CHARACTERS_LIMIT,
+    MAX_CONCURRENT_BATCHES,
+    _name_regex,
+    app,
+    fetch_character_batch,
+    fetch_character_batch_as_dict,
+    generate_marvel_hash,
+    get_all_characters_names,
+    get_auth_params,
+    get_auth_query_params,
+    get_marvel_data,
+    marvel_get,
+    stale_cache_key,
+    standardize_name,
+)
 
 # Sample API responses
 MOCK_CHARACTERS_RESPONSE = {
@@ -13,44 +32,46 @@ MOCK_CHARACTERS_RESPONSE = {
         "results": [
             {"name": "Spider-Man", "comics": {"available": 2572}},
             {"name": "Iron Man", "comics": {"available": 2411}},
-        ]
+        ],
+        "total": 2,
     }
 }
 
-MOCK_CHARACTER_RESPONSE = {
-    "data": {
-        "results": [
-            {
-                "id": 1,
-                "name": "Spider-Man",
-                "description": "Friendly neighborhood Spider-Man",
-            }
-        ]
-    }
-}
+MOCK_EMPTY_RESPONSE = {"data": {"results": [], "total": 0}}
 
-MOCK_COMICS_RESPONSE = {
-    "data": {
-        "results": [
-            {"id": 1, "title": "Amazing Spider-Man"},
-            {"id": 2, "title": "Fantastic Four"},
-        ]
-    }
-}
 
-MOCK_SERIES_RESPONSE = {
-    "data": {
-        "results": [
-            {"id": 1, "title": "Spider-Man (2023)"},
-            {"id": 2, "title": "X-Men (2023)"},
-        ]
-    }
-}
+@pytest.fixture(autouse=True)
+def response_cache():
+    # Fresh in-memory backend per test; endpoint caching itself is disabled
+    FastAPICache.reset()
+    FastAPICache.init(InMemoryBackend(), prefix="test", enable=False)
+    yield
+    FastAPICache.reset()
+
+
+@pytest.fixture
+async def mock_marvel():
+    # Route the app's Marvel client through an in-process transport
+    def install(handler):
+        app.state.client = httpx.AsyncClient(
+            base_url=BASE_URL, transport=httpx.MockTransport(handler)
+        )
+
+    yield install
+    await app.state.client.aclose()
+    del app.state.client
+
+
+@pytest.fixture
+async def client():
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+        yield ac
 
 
 # Test base endpoint
-def test_base_endpoint():
-    response = client.get("/")
+async def test_base_endpoint(client):
+    response = await client.get("/")
     assert response.status_code == 200
     assert "Marvel API app" in response.json()["message"]
     assert "version:" in response.json()
@@ -74,115 +95,450 @@ def test_get_auth_params():
 
 
 # Test characters endpoint
-@pytest.mark.asyncio
-async def test_get_characters():
-    with patch("httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
-        # Configure mock
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = MOCK_CHARACTERS_RESPONSE
+async def test_get_characters(client, mock_marvel):
+    mock_marvel(lambda request: httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE))
+
+    response = await client.get("/characters?limit=2&offset=0")
+
+    assert response.status_code == 200
+    data = response.json()
+    assert "data" in data
+    assert len(data["data"]["results"]) == 2
+    assert data["data"]["results"][0]["name"] == "Spider-Man"
+
+
+async def test_get_characters_error(client, mock_marvel):
+    mock_marvel(lambda request: httpx.Response(404))
+
+    response = await client.get("/characters")
+    assert response.status_code == 404
+    assert "Failed to fetch characters" in response.json()["detail"]
+
+
+async def test_get_characters_serves_stale_on_error(client, mock_marvel):
+    responses = iter(
+        [httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE), httpx.Response(404)]
+    )
+    mock_marvel(lambda request: next(responses))
+
+    fresh = await client.get("/characters?limit=2")
+    stale = await client.get("/characters?limit=2")
 
-        response = await client.get("/characters?limit=2&offset=0")
+    assert stale.status_code == 200
+    assert stale.json() == fresh.json()
 
-        assert response.status_code == 200
-        data = response.json()
-        assert "data" in data
-        assert len(data["data"]["results"]) == 2
-        assert data["data"]["results"][0]["name"] == "Spider-Man"
 
+async def test_get_characters_serves_stale_when_unreachable(client, mock_marvel):
+    responses = iter([httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE)])
 
-@pytest.mark.asyncio
-async def test_get_characters_error():
-    with patch("httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
-        mock_get.return_value.status_code = 404
+    def handler(request):
+        response = next(responses, None)
+        if response is None:
+            raise httpx.ConnectError("Marvel is down", request=request)
+        return response
 
-        response = await client.get("/characters")
-        assert response.status_code == 404
-        assert "Failed to fetch characters" in response.json()["detail"]
+    mock_marvel(handler)
+
+    fresh = await client.get("/characters?limit=2")
+    stale = await client.get("/characters?limit=2")
+    missing = await client.get("/characters?limit=3")
+
+    assert stale.status_code == 200
+    assert stale.json() == fresh.json()
+    assert missing.status_code == 502
+
+
+async def test_character_batches_do_not_store_stale(mock_marvel):
+    mock_marvel(lambda request: httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE))
+
+    await fetch_character_batch_as_dict(limit=2, offset=0, name="spider")
+    await asyncio.sleep(0)
+
+    params = get_auth_query_params().merge(
+        {"limit": 2, "offset": 0, "nameStartsWith": "spider"}
+    )
+    key = stale_cache_key("/characters", params)
+    assert await FastAPICache.get_backend().get(key) is None
 
 
 # Test single character endpoint
-@pytest.mark.asyncio
-async def test_get_character():
-    with patch("httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = MOCK_CHARACTER_RESPONSE
+async def test_get_character(client, mock_marvel):
+    mock_marvel(lambda request: httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE))
+
+    response = await client.get("/characters/spider man")
+
+    assert response.status_code == 200
+    assert response.json() == {"Spider-Man": 2572}
+
+
+async def test_get_character_not_found(client, mock_marvel):
+    mock_marvel(lambda request: httpx.Response(200, json=MOCK_EMPTY_RESPONSE))
 
-        response = await client.get("/characters/1")
+    response = await client.get("/characters/NonExistentCharacter")
 
-        assert response.status_code == 200
-        data = response.json()
-        assert data["data"]["results"][0]["name"] == "Spider-Man"
+    assert response.status_code == 404
+    assert "No character found" in response.json()["detail"]
 
 
-# Test comics endpoint
-@pytest.mark.asyncio
-async def test_get_comics():
-    with patch("httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = MOCK_COMICS_RESPONSE
+async def test_get_character_is_cached(client, mock_marvel):
+    FastAPICache.reset()
+    FastAPICache.init(InMemoryBackend(), prefix="test")
+    requests = []
 
-        response = await client.get("/comics?limit=2&offset=0")
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE)
 
-        assert response.status_code == 200
-        data = response.json()
-        assert len(data["data"]["results"]) == 2
-        assert data["data"]["results"][0]["title"] == "Amazing Spider-Man"
+    mock_marvel(handler)
 
+    first = await client.get("/characters/spider man")
+    second = await client.get("/characters/spider man")
 
-# Test series endpoint
-@pytest.mark.asyncio
-async def test_get_series():
-    with patch("httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = MOCK_SERIES_RESPONSE
+    assert first.headers["X-FastAPI-Cache"] == "MISS"
+    assert second.headers["X-FastAPI-Cache"] == "HIT"
+    assert second.json() == {"Spider-Man": 2572}
+    assert len(requests) == 1
 
-        response = await client.get("/series?limit=2&offset=0")
 
-        assert response.status_code == 200
-        data = response.json()
-        assert len(data["data"]["results"]) == 2
-        assert data["data"]["results"][0]["title"] == "Spider-Man (2023)"
+# Test search endpoint
+async def test_search_characters(client, mock_marvel):
+    requests = []
 
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE)
 
-# Test characters_comics endpoint
-@pytest.mark.asyncio
-async def test_get_all_characters_comics():
-    with patch("httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = MOCK_CHARACTERS_RESPONSE
+    mock_marvel(handler)
+
+    response = await client.get("/characters/search/iron man")
+
+    assert response.status_code == 200
+    assert response.json() == [{"name": "Iron Man", "comics_count": 2411}]
+    assert requests[0].url.params["nameStartsWith"] == "iron"
+
+
+# Test characters_all endpoint
+async def test_get_all_characters_names(client, mock_marvel):
+    mock_marvel(lambda request: httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE))
+
+    response = await client.get("/characters_all?limit=2")
+
+    assert response.status_code == 200
+    data = response.json()
+    assert "Spider-Man" in data
+    assert data["Spider-Man"] == 2572
+    assert "Iron Man" in data
+    assert data["Iron Man"] == 2411
+
+
+async def test_get_all_characters_names_duplicate_names(client, mock_marvel):
+    def handler(request):
+        if request.url.params["offset"] == "0":
+            # A full page whose names collapse to fewer dictionary keys
+            results = [
+                {"name": "Hero", "comics": {"available": i}} for i in range(BATCH_SIZE)
+            ]
+        else:
+            results = MOCK_CHARACTERS_RESPONSE["data"]["results"]
+        data = {"results": results, "total": BATCH_SIZE + 2}
+        return httpx.Response(200, json={"data": data})
+
+    mock_marvel(handler)
+
+    response = await client.get(f"/characters_all?limit={2 * BATCH_SIZE}")
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "Hero": BATCH_SIZE - 1,
+        "Spider-Man": 2572,
+        "Iron Man": 2411,
+    }
+
+
+async def test_get_all_characters_names_stops_at_total(client, mock_marvel):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        offset = int(request.url.params["offset"])
+        size = max(0, min(BATCH_SIZE, 100 - offset))
+        results = [
+            {"name": f"Hero {offset + i}", "comics": {"available": i}}
+            for i in range(size)
+        ]
+        return httpx.Response(200, json={"data": {"results": results, "total": 100}})
+
+    mock_marvel(handler)
+
+    response = await client.get(f"/characters_all?limit={MAX_CHARACTERS_LIMIT}")
+
+    assert response.status_code == 200
+    assert len(response.json()) == 100
+    assert len(requests) == 2
+
+
+async def test_get_all_characters_names_limit_is_clamped(client, mock_marvel):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        offset = int(request.url.params["offset"])
+        results = [
+            {"name": f"Hero {offset + i}", "comics": {"available": i}}
+            for i in range(BATCH_SIZE)
+        ]
+        data = {"results": results, "total": 10 * MAX_CHARACTERS_LIMIT}
+        return httpx.Response(200, json={"data": data})
+
+    mock_marvel(handler)
+
+    response = await client.get(f"/characters_all?limit={5 * MAX_CHARACTERS_LIMIT}")
+
+    assert response.status_code == 200
+    assert len(response.json()) == MAX_CHARACTERS_LIMIT
+    assert len(requests) == MAX_CHARACTERS_LIMIT // BATCH_SIZE
+
+
+async def test_get_all_characters_names_cancels_after_failure(client, mock_marvel):
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        offset = int(request.url.params["offset"])
+        if offset == BATCH_SIZE:
+            return httpx.Response(404)
+        if offset:
+            await asyncio.sleep(0.05)
+        results = [
+            {"name": f"Hero {offset + i}", "comics": {"available": i}}
+            for i in range(BATCH_SIZE)
+        ]
+        data = {"results": results, "total": MAX_CHARACTERS_LIMIT}
+        return httpx.Response(200, json={"data": data})
+
+    mock_marvel(handler)
+
+    response = await client.get(f"/characters_all?limit={MAX_CHARACTERS_LIMIT}")
+    await asyncio.sleep(0.1)  # Let requests already in flight finish
+
+    assert response.status_code == 404
+    # First batch, the batches in flight, and the one admitted as the failed
+    # batch released its slot; the other queued batches never start
+    assert len(requests) <= 2 + MAX_CONCURRENT_BATCHES
+
+
+# Test fallback cache key ignores per-request auth
+def test_stale_cache_key_ignores_auth():
+    first = get_auth_query_params().merge({"limit": 10, "offset": 0})
+    second = first.merge({"ts": "1", "hash": "0" * 32})
+    assert stale_cache_key("/characters", first) == stale_cache_key(
+        "/characters", second
+    )
+    assert "hash" not in stale_cache_key("/characters", first)
+
+
+# Test auth params are shared within the same second
+def test_get_auth_params_same_second():
+    with patch("main.time.time", return_value=1700000000.25):
+        first = get_auth_params()
+    with patch("main.time.time", return_value=1700000000.75):
+        second = get_auth_params()
+    assert first == second
+    assert first is not second
+    assert first["ts"] == "1700000000"
+
+
+# Test characters_all requests every batch upfront
+async def test_get_all_characters_names_batches():
+    batch = {f"Hero {i}": i for i in range(BATCH_SIZE)}
+    with patch("main.fetch_character_page", new_callable=AsyncMock) as mock_fetch:
+        mock_fetch.return_value = batch, BATCH_SIZE, 1000
+        data = await get_all_characters_names.__wrapped__(limit=120, offset=10)
+
+    calls = [call.args for call in mock_fetch.await_args_list]
+    assert calls == [(50, 10), (50, 60), (20, 110)]
+    assert data["Hero 3"] == 3
+
+
+# Test name pattern matching and reuse
+def test_name_regex():
+    regex = _name_regex("spider man")
+    assert regex.match("Spider-Man (Ultimate)")
+    assert not regex.match("Iron Man")
+    assert _name_regex("spider man") is regex
+
+
+# Test concurrent identical upstream requests are coalesced
+async def test_get_marvel_data_single_flight(mock_marvel):
+    requests = []
+
+    async def slow_handler(request):
+        requests.append(request)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE)
+
+    mock_marvel(slow_handler)
+    params = get_auth_query_params().merge({"limit": 2, "offset": 0})
+    results = await asyncio.gather(
+        *(get_marvel_data("/characters", params, "Failed") for _ in range(5))
+    )
+
+    assert len(requests) == 1
+    assert all(result == MOCK_CHARACTERS_RESPONSE for result in results)
+
+
+async def test_get_marvel_data_survives_cancelled_leader(mock_marvel):
+    async def slow_handler(request):
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE)
+
+    mock_marvel(slow_handler)
+    params = get_auth_query_params().merge({"limit": 2, "offset": 0})
+    leader = asyncio.ensure_future(get_marvel_data("/characters", params, "Failed"))
+    await asyncio.sleep(0)
+    follower = asyncio.ensure_future(get_marvel_data("/characters", params, "Failed"))
+    await asyncio.sleep(0)
+    leader.cancel()
+
+    assert await follower == MOCK_CHARACTERS_RESPONSE
+    assert leader.cancelled()
+
+
+async def test_cancelled_callers_keep_upstream_concurrency_bounded(mock_marvel):
+    in_flight = 0
+    peak = 0
+
+    async def slow_handler(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        try:
+            await asyncio.sleep(0.05)
+        finally:
+            in_flight -= 1
+        return httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE)
+
+    mock_marvel(slow_handler)
+    for round_ in range(3):
+        callers = [
+            asyncio.ensure_future(
+                fetch_character_batch_as_dict(1, round_ * BATCH_SIZE + i)
+            )
+            for i in range(MAX_CONCURRENT_BATCHES)
+        ]
+        await asyncio.sleep(0.02)
+        for caller in callers:
+            caller.cancel()
+    await asyncio.sleep(0.3)  # Let the abandoned upstream requests finish
+
+    assert peak <= MAX_CONCURRENT_BATCHES
+
+
+async def test_get_marvel_data_fallback_not_shared(mock_marvel):
+    async def slow_handler(request):
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE)
+
+    mock_marvel(slow_handler)
+    params = get_auth_query_params().merge({"limit": 50, "offset": 0})
+    await asyncio.gather(
+        get_marvel_data("/characters", params, "Failed"),
+        get_marvel_data("/characters", params, "Failed", fallback=True),
+    )
+    await asyncio.sleep(0)
+
+    key = stale_cache_key("/characters", params)
+    assert await FastAPICache.get_backend().get(key) is not None
+
+
+def test_batch_semaphore_across_event_loops():
+    async def slow_handler(request):
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE)
+
+    async def contend():
+        app.state.client = httpx.AsyncClient(
+            base_url=BASE_URL, transport=httpx.MockTransport(slow_handler)
+        )
+        try:
+            # More batches than semaphore slots, so some have to wait
+            return await asyncio.gather(
+                *(
+                    fetch_character_batch_as_dict(1, offset)
+                    for offset in range(MAX_CONCURRENT_BATCHES + 4)
+                )
+            )
+        finally:
+            await app.state.client.aclose()
+            del app.state.client
+
+    for _ in range(2):
+        batches = asyncio.run(contend())
+        assert all(batch == {"Spider-Man": 2572, "Iron Man": 2411} for batch in batches)
+
+
+# Test throttled upstream requests are retried
+async def test_marvel_get_retries_throttled(mock_marvel):
+    responses = iter([httpx.Response(429), httpx.Response(503), httpx.Response(200)])
+    mock_marvel(lambda request: next(responses))
+
+    with patch("main.asyncio.sleep", new_callable=AsyncMock) as mock_sleep:
+        response = await marvel_get("/characters", get_auth_query_params())
+
+    assert response.status_code == 200
+    assert mock_sleep.await_count == 2
+
+
+# Test characters_all streaming endpoint
+async def test_stream_all_characters_names(client, mock_marvel):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        offset = int(request.url.params["offset"])
+        size = max(0, min(BATCH_SIZE, 120 - offset))
+        results = [
+            {"name": f"Hero {offset + i}", "comics": {"available": i}}
+            for i in range(size)
+        ]
+        return httpx.Response(200, json={"data": {"results": results, "total": 120}})
+
+    mock_marvel(handler)
+
+    response = await client.get(f"/characters_all/stream?limit={MAX_CHARACTERS_LIMIT}")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert len(rows) == 120
+    assert {"Hero 0": 0} in rows
+    assert {"Hero 119": 19} in rows
+    assert len(requests) == 3
 
-        response = await client.get("/characters_comics?limit=2")
 
-        assert response.status_code == 200
-        data = response.json()
-        assert "Spider-Man" in data
-        assert data["Spider-Man"] == 2572
-        assert "Iron Man" in data
-        assert data["Iron Man"] == 2411
+async def test_stream_all_characters_names_error(client, mock_marvel):
+    mock_marvel(lambda request: httpx.Response(404))
 
+    response = await client.get("/characters_all/stream")
 
-# Test character_comics endpoint
-@pytest.mark.asyncio
-async def test_get_character_comics():
-    with patch("httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = MOCK_CHARACTERS_RESPONSE
+    assert response.status_code == 404
+    assert "Failed to fetch characters" in response.json()["detail"]
 
-        response = await client.get("/character_comics/Spider-Man")
 
-        assert response.status_code == 200
-        data = response.json()
-        assert "Spider-Man" in data
-        assert data["Spider-Man"] == 2572
+# Test name standardization
+def test_standardize_name():
+    assert standardize_name("Spider-Man (Ultimate)") == "Spider Man"
+    assert standardize_name("  Peter  Parker's ") == "Peter Parkers"
 
 
-@pytest.mark.asyncio
-async def test_get_character_comics_not_found():
-    with patch("httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = {"data": {"results": []}}
+# Test batch helpers project name and comic count
+async def test_fetch_character_batch_as_dict(mock_marvel):
+    mock_marvel(lambda request: httpx.Response(200, json=MOCK_CHARACTERS_RESPONSE))
 
-        response = await client.get("/character_comics/NonExistentCharacter")
+    everyone = await fetch_character_batch_as_dict(limit=2, offset=0)
+    spiders = await fetch_character_batch_as_dict(limit=2, offset=0, name="spider")
+    as_list = await fetch_character_batch(limit=2, offset=0, name="iron man")
 
-        assert response.status_code == 404
-        assert "Character not found" in response.json()["detail"]
+    assert everyone == {"Spider-Man": 2572, "Iron Man": 2411}
+    assert spiders == {"Spider-Man": 2572}
+    assert as_list == [{"name": "Iron Man", "comics_count": 2411}]